@@ -0,0 +1,507 @@
+# ===============================
+# AI Marketing Engine - Core
+# Data, prompt and generation helpers
+# ===============================
+# Imported once per process: unlike the Streamlit entry script, this module is
+# not re-executed on every rerun, so constants, templates and cached functions
+# are only built once.
+
+import streamlit as st
+import pandas as pd
+import numpy as np
+import os
+import json
+import io
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI
+from dotenv import load_dotenv
+import plotly.express as px
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional; responses are parsed with the json module
+    json_loads = json.loads
+
+# --- CLIENT ---
+@st.cache_resource
+def get_client():
+    """Create the OpenAI client once so its connection pool is reused across reruns"""
+    # Load OpenAI API key from .env, falling back to Streamlit secrets
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        try:
+            api_key = st.secrets.get("OPENAI_API_KEY")
+        except FileNotFoundError:  # No secrets.toml configured
+            api_key = None
+    return OpenAI(api_key=api_key) if api_key else None
+
+# --- SETTINGS ---
+# Low-cardinality text columns stored as categoricals (integer codes + small lookup)
+CATEGORICAL_COLUMNS = ('loyalty_tier', 'country', 'customer_segment', 'region',
+                       'product_interest', 'preferred_language')
+
+# Customer fields sent to the model for email personalization
+EMAIL_FIELDS = ['customer_name', 'product_interest', 'region', 'country', 'engagement_score',
+                'loyalty_tier', 'purchase_history', 'preferred_language']
+# ROI table rows and the analyze_customer_segments() segment each one reads
+ROI_SEGMENTS = {'high_value': 'high_value', 'loyal': 'loyal_customers',
+                'new': 'new_customers', 'at_risk': 'at_risk'}
+# Upper bound on points drawn in the engagement scatter plot
+MAX_SCATTER_POINTS = 5000
+# Customer rows packed into a single email-generation request
+EMAIL_BATCH_SIZE = 20
+# OpenAI Batch API limits on a single input file
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+# Problems listed before the rest are summarized as a count
+MAX_PROBLEMS_SHOWN = 10
+# gpt-4o-mini rate limits shared by every session in this process
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 200_000
+# Completion tokens budgeted per request when throttling (prompt tokens ~ chars / 4)
+COMPLETION_TOKEN_ESTIMATE = 1000
+# Completion tokens allowed per customer in an email request (sent as max_tokens)
+EMAIL_TOKENS_PER_CUSTOMER = 500
+# Finished streamed completions kept for reuse across sessions
+COMPLETION_STORE_SIZE = 256
+# Seconds a generated completion is reused before the prompt is sent again
+COMPLETION_TTL = 3600
+
+# --- PROMPT TEMPLATES ---
+# Static scaffolding is parsed once; customer data goes last in the email
+# template so batches share an identical prefix (eligible for prompt caching)
+EMAIL_TEMPLATE = """\
+Create a personalized {campaign_type} email for each customer listed below.
+
+Requirements:
+- Tone: {tone}
+- Personalization Level: {personalization_level}/5
+- Include offers: {include_offers}
+- Add urgency: {include_urgency}
+- Include social proof: {include_social_proof}
+
+Generate a complete email for every customer with subject line, body, and call-to-action.
+Respond with a JSON object of the form
+{{"emails": [{{"row_id": <row_id>, "customer": "<customer_name>", "subject": "...", "body": "..."}}]}}
+containing one entry per customer row, echoing that row's row_id.
+
+Customers:
+{customers}
+"""
+
+SOCIAL_TEMPLATE = """\
+Create {post_count} {platform} {content_type_lower} posts for this audience:
+{data}
+
+Requirements:
+- Platform: {platform}
+- Content Type: {content_type}
+- Target: {target_audience}
+- Include hashtags: {include_hashtags}
+- Include CTA: {include_cta}
+- Emoji style: {emoji_style}
+
+Make each post unique and engaging for the platform.
+"""
+
+AD_COPY_TEMPLATE = """\
+Create {ad_variations} {ad_platform} ad variations for this customer data:
+{data}
+
+Requirements:
+- Platform: {ad_platform}
+- Objective: {ad_objective}
+- Target: {target_segment}
+- Headline Style: {headline_style}
+- Include emojis: {include_emoji}
+
+For each variation, include:
+1. Headline (30-60 characters)
+2. Description (90-150 characters)
+3. Call-to-Action
+4. Key benefits
+"""
+
+AB_TEST_TEMPLATE = """\
+Create {variant_count} {test_type_lower} variants for A/B testing:
+
+Customer Data: {data}
+
+Test Parameters:
+- Type: {test_type}
+- Duration: {test_duration}
+- Metric: {target_metric}
+- Audience: {audience_size} customers
+- Confidence: {confidence_level}
+
+For each variant, provide:
+1. The content
+2. Expected performance
+3. Target audience segment
+4. Success metrics
+"""
+
+# Structured-output schema for email batches; the API guarantees parseable JSON
+EMAIL_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "email_batch",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "emails": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "row_id": {"type": "integer"},
+                            "customer": {"type": "string"},
+                            "subject": {"type": "string"},
+                            "body": {"type": "string"}
+                        },
+                        "required": ["row_id", "customer", "subject", "body"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["emails"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# --- HELPER FUNCTIONS ---
+class RateLimiter:
+    """Token-bucket throttle on requests and tokens per minute, safe across threads"""
+    
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, tokens):
+        """Block until one request spending roughly `tokens` tokens fits under both limits"""
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed, self._updated = now - self._updated, now
+                self._requests = min(self.requests_per_minute,
+                                     self._requests + elapsed * self.requests_per_minute / 60)
+                self._tokens = min(self.tokens_per_minute,
+                                   self._tokens + elapsed * self.tokens_per_minute / 60)
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max((1 - self._requests) * 60 / self.requests_per_minute,
+                           (tokens - self._tokens) * 60 / self.tokens_per_minute)
+            time.sleep(wait)
+
+@st.cache_resource
+def get_rate_limiter():
+    """One limiter per process, since the API key's limits are shared by all sessions"""
+    return RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+def throttle(prompt, completion_tokens=COMPLETION_TOKEN_ESTIMATE):
+    """Wait for capacity before sending a prompt"""
+    get_rate_limiter().acquire(len(prompt) // 4 + completion_tokens)
+
+def file_digest(file_bytes):
+    """Fingerprint uploaded bytes; the digest keys every per-dataset cache"""
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner=False)
+def load_csv(data_key, _uploaded_file):
+    """Parse the uploaded CSV once per unique file instead of on every rerun"""
+    file_bytes = _uploaded_file.getvalue()
+    # Categorical columns are requested up front (absent ones are ignored). The C
+    # engine builds their codes while tokenizing; the pyarrow engine reads the
+    # table first and converts them afterwards, the same work as an astype()
+    dtype = {col: 'category' for col in CATEGORICAL_COLUMNS}
+    try:
+        # PyArrow's reader is multithreaded and much faster on wide files
+        df = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow", dtype=dtype)
+    except (ImportError, ValueError):
+        # Missing pyarrow, or a file only the C parser accepts (e.g. ragged rows)
+        df = pd.read_csv(io.BytesIO(file_bytes), dtype=dtype)
+    return df
+
+@st.cache_resource
+def get_completion_store():
+    """Finished streamed completions shared by every session, oldest evicted first"""
+    # Maps (model, prompt) to (expiry time, text)
+    return OrderedDict()
+
+_completion_store_lock = threading.Lock()
+
+def stream_completion(model, prompt):
+    """Stream a completion onto the page, replaying the finished text for repeat prompts"""
+    store = get_completion_store()
+    key = (model, prompt)
+    with _completion_store_lock:
+        expires, text = store.get(key, (0, None))
+        if text is not None and expires <= time.monotonic():
+            del store[key]
+            text = None
+    if text is not None:
+        st.markdown(text)
+        return
+    
+    throttle(prompt)
+    stream = get_client().chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True
+    )
+    text = st.write_stream(
+        chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices
+    )
+    with _completion_store_lock:
+        store[key] = (time.monotonic() + COMPLETION_TTL, text)
+        store.move_to_end(key)
+        while len(store) > COMPLETION_STORE_SIZE:
+            store.popitem(last=False)
+
+# Per-dataset helpers are keyed on the upload's data_key; the leading underscore
+# on _df tells st.cache_data to skip hashing the whole frame on every call
+@st.cache_data(show_spinner=False)
+def analyze_customer_segments(data_key, _df):
+    """Analyze customer data to create behavioral segments (as row position arrays)"""
+    # Pull each column out once and build every mask in a single pass;
+    # the text comparisons run on the categorical codes before leaving pandas
+    eng = _df['engagement_score'].to_numpy()
+    newcomer = (_df['customer_segment'] == 'newcomer').to_numpy()
+    loyal = _df['loyalty_tier'].isin(['gold', 'platinum']).to_numpy()
+    international = (_df['country'] != 'US').to_numpy()
+    
+    segments = {
+        'high_value': np.flatnonzero(eng >= 80),
+        'at_risk': np.flatnonzero(eng < 60),
+        'new_customers': np.flatnonzero(newcomer),
+        'loyal_customers': np.flatnonzero(loyal),
+        'international': np.flatnonzero(international)
+    }
+    return segments
+
+@st.cache_data(show_spinner=False)
+def segment_table(data_key, _df):
+    """Count customers and average engagement for each ROI table segment"""
+    # Segments overlap (a loyal customer can also be at risk), so each row
+    # reads its own position array rather than a single partition
+    eng = _df['engagement_score'].to_numpy()
+    segments = analyze_customer_segments(data_key, _df)
+    rows = {label: segments[key] for label, key in ROI_SEGMENTS.items()}
+    return pd.DataFrame({
+        'size': [idx.size for idx in rows.values()],
+        'mean': [np.nanmean(eng[idx]) if idx.size > 0 else 0 for idx in rows.values()]
+    }, index=list(rows))
+
+@st.cache_data(show_spinner=False)
+def value_counts(data_key, _df, col):
+    """Count the values of one column, once per dataset"""
+    series = _df[col]
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Tally the integer codes directly; -1 marks missing values
+        codes = series.cat.codes.to_numpy()
+        counts = np.bincount(codes[codes >= 0], minlength=len(series.cat.categories))
+        return pd.Series(counts, index=series.cat.categories).sort_values(ascending=False)
+    return series.value_counts()
+
+@st.cache_data(show_spinner=False)
+def calculate_roi_metrics(data_key, _df):
+    """Calculate ROI and conversion metrics"""
+    eng = _df['engagement_score'].to_numpy()
+    total_customers = eng.size
+    high_engagement = int((eng >= 70).sum())
+    conversion_rate = (high_engagement / total_customers) * 100 if total_customers > 0 else 0
+    
+    return {
+        'total_customers': total_customers,
+        'high_engagement_rate': conversion_rate,
+        'avg_engagement': np.nanmean(eng) if total_customers > 0 else 0,
+        'revenue_potential': np.nansum(_df['purchase_history'].to_numpy()) * 50  # Assuming $50 avg order value
+    }
+
+def build_email_prompt(customers, campaign_type, tone, personalization_level,
+                       include_offers, include_urgency, include_social_proof):
+    """Build one prompt asking for a personalized email for every customer row"""
+    return EMAIL_TEMPLATE.format(
+        campaign_type=campaign_type.lower(),
+        tone=tone.lower(),
+        personalization_level=personalization_level,
+        include_offers=include_offers,
+        include_urgency=include_urgency,
+        include_social_proof=include_social_proof,
+        customers=customers.to_csv(index_label='row_id')
+    )
+
+@st.cache_data(show_spinner=False, ttl=COMPLETION_TTL)
+def cached_email_completion(model, prompt, max_tokens):
+    """Return the structured email batch for a prompt, memoized across reruns"""
+    # The throttle budget is the same cap the API enforces on the reply
+    throttle(prompt, completion_tokens=max_tokens)
+    response = get_client().chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        response_format=EMAIL_RESPONSE_FORMAT,
+        max_tokens=max_tokens
+    )
+    return response.choices[0].message.content
+
+def generate_emails(prompts, row_counts, max_workers=10):
+    """Send the batched email prompts from a thread pool (the HTTP calls release the GIL)"""
+    def gen(prompt, rows):
+        try:
+            return cached_email_completion("gpt-4o-mini", prompt, rows * EMAIL_TOKENS_PER_CUSTOMER)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(gen, prompts, row_counts))
+
+def submit_email_batch(prompts):
+    """Queue email prompts on the OpenAI Batch API (half price, separate rate limits)
+
+    Only as many prompts as fit in one batch file are sent; returns the batch id
+    and how many of the leading prompts it covers.
+    """
+    lines, size = [], 0
+    for i, prompt in enumerate(prompts[:BATCH_MAX_REQUESTS]):
+        line = json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o-mini",
+                "messages": [{"role": "user", "content": prompt}],
+                "response_format": EMAIL_RESPONSE_FORMAT
+            }
+        }).encode()
+        if size + len(line) + 1 > BATCH_MAX_BYTES:
+            break
+        lines.append(line)
+        size += len(line) + 1
+    client = get_client()
+    batch_file = client.files.create(file=("email_batch.jsonl", b"\n".join(lines)),
+                                     purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id,
+                                  endpoint="/v1/chat/completions",
+                                  completion_window="24h")
+    return batch.id, len(lines)
+
+def fetch_email_batch(batch_id, prompt_count):
+    """Return a batch's status and, once completed, one result per prompt (in order)"""
+    client = get_client()
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        return batch.status, None
+    
+    results = [RuntimeError("no response returned")] * prompt_count
+    # Successful requests land in the output file, failed ones in the error file
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            record = json_loads(line)
+            response = record.get('response') or {}
+            if record.get('error') or response.get('status_code') != 200:
+                error = record.get('error') or response.get('body', {}).get('error')
+                results[int(record['custom_id'])] = RuntimeError(str(error))
+            else:
+                results[int(record['custom_id'])] = response['body']['choices'][0]['message']['content']
+    return batch.status, results
+
+def collect_emails(batches, results):
+    """Match each batch's emails to its customer rows by the row_id they echo"""
+    emails, problems = [], []
+    for customers, result in zip(batches, results):
+        names = ", ".join(customers['customer_name'].astype(str))
+        if isinstance(result, Exception):
+            problems.append(f"Error generating emails for {names}: {result}")
+            continue
+        try:
+            replies = json_loads(result)['emails']
+        except (ValueError, KeyError, TypeError) as e:
+            problems.append(f"Could not read the emails generated for {names}: {e}")
+            continue
+        
+        matched, unknown = set(), []
+        for email_data in replies:
+            row_id = email_data.get('row_id')
+            # Names come from the uploaded rows, never from the model's echo
+            if row_id in customers.index and row_id not in matched:
+                matched.add(row_id)
+                emails.append({'row_id': row_id,
+                               'customer_name': customers.at[row_id, 'customer_name'],
+                               'subject': email_data.get('subject', ''),
+                               'body': email_data.get('body', '')})
+            else:
+                unknown.append(row_id)
+        missing = customers.loc[~customers.index.isin(matched), 'customer_name']
+        if len(missing) > 0:
+            problems.append(f"No email returned for: {', '.join(missing.astype(str))}")
+        if unknown:
+            problems.append(f"Ignored emails with unknown or repeated row_id: {unknown}")
+    # Batches may finish in any order; reassemble in customer order
+    emails.sort(key=lambda email: email['row_id'])
+    return emails, problems
+
+def show_problems(problems):
+    """Show the first few email problems and count the rest"""
+    for problem in problems[:MAX_PROBLEMS_SHOWN]:
+        st.error(problem)
+    if len(problems) > MAX_PROBLEMS_SHOWN:
+        st.error(f"...and {len(problems) - MAX_PROBLEMS_SHOWN} more problems")
+
+def render_emails(batches, results):
+    """Parse batched email responses and show one expander per customer"""
+    emails, problems = collect_emails(batches, results)
+    show_problems(problems)
+    
+    st.success(f"✅ Generated {len(emails)} personalized emails!")
+    
+    for email_data in emails:
+        with st.expander(f"📧 Email for {email_data['customer_name']}"):
+            st.markdown(f"**Subject:** {email_data['subject']}")
+            st.markdown(email_data['body'])
+
+# --- CHART BUILDERS ---
+# Figures are memoized on their (hashable) inputs so reruns reuse them
+@st.cache_data(show_spinner=False)
+def pie_chart(items, title):
+    """Build a pie chart from (name, value) pairs"""
+    return px.pie(values=[v for _, v in items], names=[k for k, _ in items], title=title)
+
+@st.cache_data(show_spinner=False)
+def bar_chart(items, title):
+    """Build a bar chart from (label, count) pairs"""
+    return px.bar(x=[k for k, _ in items], y=[v for _, v in items], title=title)
+
+@st.cache_data(show_spinner=False)
+def engagement_histogram(data_key, _df):
+    """Bin engagement scores in NumPy so Plotly receives 20 bars instead of every score"""
+    counts, edges = np.histogram(_df['engagement_score'].dropna().to_numpy(), bins=20)
+    fig = px.bar(x=(edges[:-1] + edges[1:]) / 2, y=counts,
+                 title="Customer Engagement Distribution",
+                 labels={'x': 'engagement_score', 'y': 'count'})
+    fig.update_layout(bargap=0)
+    return fig
+
+@st.cache_data(show_spinner=False)
+def engagement_scatter(data_key, _df):
+    """Plot engagement against purchases, capping the points shipped to the browser"""
+    if len(_df) > MAX_SCATTER_POINTS:
+        _df = _df.sample(MAX_SCATTER_POINTS, random_state=0)
+    return px.scatter(_df, x='engagement_score', y='purchase_history',
+                      color='loyalty_tier', size='purchase_history',
+                      title="Customer Engagement vs Purchase History")